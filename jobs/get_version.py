@@ -7,12 +7,11 @@ Purpose:
 - Store the parsed output in a Nautobot model
 - Create a relationship between the device and the software version
 """
+from concurrent.futures import ThreadPoolExecutor
+
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 
-# Import Netmiko to connect to the device and execute commands
-from netmiko import ConnectHandler
-
 # Import Nautobot DCIM device models
 from nautobot.dcim.models import Device
 from nautobot.apps.jobs import register_jobs, Job, ObjectVar, MultiObjectVar
@@ -21,11 +20,35 @@ from nautobot.extras.models import Tag, Relationship, RelationshipAssociation
 from nautobot_device_lifecycle_mgmt.models import SoftwareLCM
 
 import re
-import os
+import socket
 
 # Setting the name here gives a category for these jobs to be categorized into
 name = "Demo Jobs"
 
+# Netmiko platforms this job knows how to get and parse the version for
+SUPPORTED_DRIVERS = frozenset({"arista_eos", "keymile_nos", "cisco_xr", "cisco_ios"})
+
+# Command used to get the version information, per Netmiko platform
+SHOW_VERSION_COMMANDS = {
+    "arista_eos": "show version",
+    "keymile_nos": "show version",
+    "cisco_xr": "show version",
+    "cisco_ios": "show version | inc Cisco IOS Software"
+}
+
+# Pattern used to parse the software version out of the command output, per Netmiko platform
+PATTERNS = {
+    "arista_eos": re.compile(r"Software image version: (?P<version>\S+)"),
+    "keymile_nos": re.compile(r"NOS version (?P<version>\S+)"),
+    "cisco_xr": re.compile(r"Cisco IOS XR Software, Version (?P<version>\S+)"),
+    "cisco_ios": re.compile(r"Version (?P<version>\S+)")
+}
+
+# Prompt to wait for after the show version command, per Netmiko platform (default: autodetect)
+EXPECT_STRINGS = {
+    "cisco_ios": r"#",
+}
+
 class GetShowVersion(Job):
     devices = MultiObjectVar(
         model=Device,
@@ -48,6 +71,9 @@ class GetShowVersion(Job):
 
     # The code execution, all things for the job are here.
     def run(self, devices):
+        # Import Netmiko to connect to the device and execute commands. It is imported here so job
+        # registration does not load it, and before the thread pool starts so only one thread imports it.
+        from netmiko import ConnectHandler
 
         def print_status(status, message):
             if status == 'info':
@@ -60,71 +86,68 @@ class GetShowVersion(Job):
                 self.logger.failure(message)
 
         class OnboardVersion:
-            def __init__(self, device):
+            def __init__(self, device, credentials):
                 self.device = device
-                self.supported_drivers = ["arista_eos", "keymile_nos", "cisco_xr", "cisco_ios"]
-                print_status("info", f"Currently supported platforms: {self.supported_drivers}")
+                # str(device) may query related objects, so build it here in the job thread
+                self.device_label = str(device)
 
                 self.platform = self.device.platform.network_driver
 
-                if self.platform not in self.supported_drivers:
+                if self.platform not in SUPPORTED_DRIVERS:
                     raise Exception(f"Device {self.device} with platform {self.platform} is not supported")
 
                 self.device_info = {
                     "device_type": self.platform,
                     "ip": self.device.primary_ip.host,
-                    "username": Secret.objects.get(name="SSH_USERNAME").get_value(),
-                    "password": Secret.objects.get(name="SSH_PASSWORD").get_value(),
-                    "secret": Secret.objects.get(name="SSH_SECRET").get_value(),
-                }
-                self.show_version_commands = {
-                    "arista_eos": "show version",
-                    "keymile_nos": "show version",
-                    "cisco_xr": "show version",
-                    "cisco_ios": "show version | inc Cisco IOS Software"
-                }
-                self.patterns = {
-                    "arista_eos": r"Software image version: (\S+)",
-                    "keymile_nos": r"NOS version (\S+)",
-                    "cisco_xr": r"Cisco IOS XR Software, Version (\S+)",
-                    "cisco_ios": r"Version (\S+)"
+                    "fast_cli": True,
+                    "conn_timeout": 8,
+                    "banner_timeout": 5,
+                    "auth_timeout": 8,
+                    **credentials,
                 }
 
                 self.raw_version = None
                 self.parsed_version = None
                 self.nautobot_software = None
+                # Messages from the worker thread, logged later from the job thread
+                self.messages = []
 
             def get_version(self):
-                print_status("info", f"Device name: {self.device}")
-                print_status("info", f"Device IP: {self.device_info['ip']}")
-                print_status("info", f"Device platform: {self.device_info['device_type']}")
-
-                # Ping the device before connecting
-                if os.system(f"ping -c 1 {self.device_info['ip']}") != 0:
+                self.messages.append(("info", f"Device name: {self.device_label}"))
+                self.messages.append(("info", f"Device IP: {self.device_info['ip']}"))
+                self.messages.append(("info", f"Device platform: {self.device_info['device_type']}"))
+
+                # Check that the SSH port is reachable before connecting
+                try:
+                    socket.create_connection((self.device_info["ip"], 22), timeout=2).close()
+                except OSError:
                     raise Exception(f"Device with IP {self.device_info['ip']} is unreachable")
 
                 with ConnectHandler(**self.device_info) as session:
                     session.enable()
-                    self.raw_version = session.send_command(self.show_version_commands.get(self.platform))
+                    self.raw_version = session.send_command(
+                        SHOW_VERSION_COMMANDS[self.platform],
+                        expect_string=EXPECT_STRINGS.get(self.platform),
+                    )
                     # print_status("info", self.raw_version)
 
             def parse_version(self):
-                match = re.search(self.patterns.get(self.platform), self.raw_version)
+                match = PATTERNS[self.platform].search(self.raw_version)
                 if match:
-                    self.parsed_version = (match.group(1)).strip(',')
-                    print_status("info", f"Device software version: {self.parsed_version}")
+                    self.parsed_version = (match.group("version")).strip(',')
+                    self.messages.append(("info", f"Device software version: {self.parsed_version}"))
                 else:
-                    raise Exception(f"Could not parse, pattern not found in the input string: {self.patterns.get(self.platform)}")
+                    raise Exception(f"Could not parse, pattern not found in the input string: {PATTERNS[self.platform].pattern}")
 
             def import_to_nautobot(self):
                 # Check if software exists in nautobot database. If not, create it.
-                if SoftwareLCM.objects.filter(version=self.parsed_version).exists():
+                try:
                     self.nautobot_software = SoftwareLCM.objects.get(version=self.parsed_version)
                     print_status(
                         "info",
                         f"Software version {self.nautobot_software} exists in the database."
                     )
-                else:
+                except SoftwareLCM.DoesNotExist:
                     self.nautobot_software = SoftwareLCM(version=self.parsed_version, device_platform=self.device.platform)
                     self.nautobot_software.validated_save()
                     print_status(
@@ -132,42 +155,91 @@ class GetShowVersion(Job):
                         f"Created software version {self.nautobot_software} in the database."
                     )
 
-            def assign_to_device(self):
-                # Check if software to dev relationship already exists. If not, create it.
-                software_rel = Relationship.objects.get(label="Software on Device")
-                if RelationshipAssociation.objects.filter(
-                    relationship=software_rel.id,
-                    source_id=self.nautobot_software.id,
-                    destination_id=self.device.id,
-                ).exists():
-                    print_status(
-                        "info",
-                        f"Relationship {self.device} <-> {self.nautobot_software} exists."
-                    )
-                else:
-                    source_ct = ContentType.objects.get(model="softwarelcm")
-                    dest_ct = ContentType.objects.get(model="device")
-                    created_rel = RelationshipAssociation(
-                        relationship=software_rel,
-                        source_type=source_ct,
-                        source=self.nautobot_software,
-                        destination_type=dest_ct,
-                        destination=self.device,
-                    )
-                    created_rel.validated_save()
-                    print_status(
-                        "info",
-                        f"Created {self.device} <-> {self.nautobot_software} relationship."
-                    )
-
-            def execute(self):
+            def collect(self):
+                # Runs in a worker thread, so only network I/O happens here. The job logger is not
+                # usable from worker threads, so messages are kept in self.messages instead.
                 self.get_version()
                 self.parse_version()
-                self.import_to_nautobot()
-                self.assign_to_device()
 
+        # These are the same for every device, so look them up once per job run.
+        credentials = {
+            "username": Secret.objects.get(name="SSH_USERNAME").get_value(),
+            "password": Secret.objects.get(name="SSH_PASSWORD").get_value(),
+            "secret": Secret.objects.get(name="SSH_SECRET").get_value(),
+        }
+        software_rel = Relationship.objects.get(label="Software on Device")
+        source_ct = ContentType.objects.get_for_model(SoftwareLCM)
+        dest_ct = ContentType.objects.get_for_model(Device)
+
+        print_status("info", f"Currently supported platforms: {sorted(SUPPORTED_DRIVERS)}")
+
+        # Devices that could not be onboarded; the job fails at the end if there are any
+        failed = []
+        tasks = []
         for device in devices:
-            task = OnboardVersion(device)
-            task.execute()
+            try:
+                tasks.append(OnboardVersion(device, credentials))
+            except Exception as err:
+                print_status("failure", f"Skipping device {device}: {err}")
+                failed.append(device)
+
+        # Connecting to the devices is I/O-bound, so do it concurrently and keep the DB writes serial.
+        onboarded = []
+        with ThreadPoolExecutor(max_workers=max(1, min(32, len(tasks)))) as executor:
+            futures = [(task, executor.submit(task.collect)) for task in tasks]
+            for task, future in futures:
+                error = future.exception()
+                for status, message in task.messages:
+                    print_status(status, message)
+                if error is not None:
+                    print_status("failure", f"Skipping device {task.device}: {error}")
+                    failed.append(task.device)
+                    continue
+                try:
+                    task.import_to_nautobot()
+                except Exception as err:
+                    print_status("failure", f"Skipping device {task.device}: {err}")
+                    failed.append(task.device)
+                    continue
+                onboarded.append(task)
+
+        # Check which software to dev relationships already exist in one query, then create the missing ones.
+        existing = set(
+            RelationshipAssociation.objects.filter(
+                relationship=software_rel,
+                destination_type=dest_ct,
+                destination_id__in=[task.device.id for task in onboarded],
+            ).values_list("source_id", "destination_id")
+        )
+        for task in onboarded:
+            if (task.nautobot_software.id, task.device.id) in existing:
+                print_status(
+                    "info",
+                    f"Relationship {task.device} <-> {task.nautobot_software} exists."
+                )
+                continue
+            created_rel = RelationshipAssociation(
+                relationship=software_rel,
+                source_type=source_ct,
+                source=task.nautobot_software,
+                destination_type=dest_ct,
+                destination=task.device,
+            )
+            try:
+                created_rel.validated_save()
+            except Exception as err:
+                print_status(
+                    "failure",
+                    f"Could not create {task.device} <-> {task.nautobot_software} relationship: {err}"
+                )
+                failed.append(task.device)
+                continue
+            print_status(
+                "info",
+                f"Created {task.device} <-> {task.nautobot_software} relationship."
+            )
+
+        if failed:
+            raise RuntimeError(f"{len(failed)} device(s) failed: {', '.join(str(device) for device in failed)}")
 
 register_jobs(GetShowVersion)